@@ -6,13 +6,19 @@ Description:
 """
 
 import math
-import csv
-from scipy.stats import pearsonr
+from itertools import groupby
+import numpy as np
+import pandas as pd
+from numba import njit, prange
+from scipy.sparse import csr_matrix, vstack
 
 class BadInputError(Exception):
     pass
 
 class Movie_Recommendations:
+    # most similarity rows kept in sim_row_cache at once
+    sim_row_cache_size = 256
+
     # Constructor
     def __init__(self, movie_filename, training_ratings_filename):
         """
@@ -24,24 +30,24 @@ class Movie_Recommendations:
         self.user_dict - A dictionary that maps user id's to a 
                a dictionary that maps a movie id to the rating
                that the user gave to the movie.    
+        Ratings must be on the half star scale: multiples of 0.5
+        from 0 to 5.  If any training rating is not, then
+        BadInputError is raised.
         """
         self.movie_dict = dict()
         try:
-            f1 = open(movie_filename)
+            # the first row of labels is read as the header
+            movies = pd.read_csv(movie_filename, usecols=[0, 1],
+                                 dtype={0: np.int64, 1: str}, na_filter=False)
         except OSError:
             print("file not able to open")    
 
-        csv_reader1 = csv.reader(f1, delimiter=',', quotechar='"')
-
-        f1.readline() # skip the first row of labels
-
-        for line in csv_reader1:
-            mov_id, mov_title = int(line[0]), line[1]
+        for mov_id, mov_title in zip(movies.iloc[:, 0].tolist(), movies.iloc[:, 1].tolist()):
             self.movie_dict[mov_id] = Movie(mov_id, mov_title)
         # print(self.movie_dict)   
         """
         create the userid dictionary to house the dictionary of movie titles
-        and ratings for that user. We will create a .csv file reader, assign the
+        and ratings for that user. We will read the .csv file into columns, assign the
         userid to a variable and check if that is in the dictionary of users.
         If not, we will create a dictionary and assign it to the user id.
         We will then read the file and assign all non-zero movie ratings as the value
@@ -49,24 +55,97 @@ class Movie_Recommendations:
         """
         self.user_dict = dict()
         try:
-            f2 = open(training_ratings_filename)
+            training = pd.read_csv(training_ratings_filename, usecols=[0, 1, 2],
+                                   dtype={0: np.int64, 1: np.int64, 2: np.float64})
         except OSError:
             print("file not able to open")  
-     
-        csv_reader2 = csv.reader(f2, delimiter=',')
-        f2.readline()
 
-        for line in csv_reader2:
-            cur_user_id, mov_id, mov_rating = int(line[0]), int(line[1]), float(line[2])
+        # if a user rated a movie more than once, the last rating counts
+        training = training.drop_duplicates(subset=training.columns[:2].tolist(), keep='last')
+
+        # the ratings are also kept as three parallel columns
+        user_ids = training.iloc[:, 0].to_numpy()
+        mov_ids = training.iloc[:, 1].to_numpy()
+        values = training.iloc[:, 2].to_numpy()
 
-            if cur_user_id not in self.user_dict:
-                self.user_dict[cur_user_id] = dict()
-            self.user_dict[cur_user_id][mov_id] = mov_rating     
-            self.movie_dict[mov_id].users.append(cur_user_id)
+        user_dict, movie_dict = self.user_dict, self.movie_dict
+        for cur_user_id, mov_id, mov_rating in zip(user_ids.tolist(), mov_ids.tolist(),
+                                                   values.tolist()):
+            ratings = user_dict.get(cur_user_id)
+            if ratings is None:
+                ratings = user_dict[cur_user_id] = dict()
+            ratings[mov_id] = mov_rating     
+            movie_dict[mov_id].users.append(cur_user_id)
                 
         # print(self.user_dict)
         # for i in range(1, 6):
         #     print(self.movie_dict[i].users) 
+        for movie in self.movie_dict.values():
+            movie.user_set = frozenset(movie.users)
+
+        """
+        Number the users and movies with contiguous row and column
+        indices, in order of id.  Every movie in the movie file gets a
+        column, rated or not.  All of the arrays below are indexed by
+        these; user_index and movie_index map ids to them.
+        """
+        user_labels, rows = np.unique(user_ids, return_inverse=True)
+        movie_labels = np.unique(movies.iloc[:, 0].to_numpy())
+        cols = np.searchsorted(movie_labels, mov_ids)
+        rows, cols = rows.astype(np.int32), cols.astype(np.int32)
+        self.user_index = {user_id: row for row, user_id in enumerate(user_labels.tolist())}
+        self.movie_index = {mov_id: col for col, mov_id in enumerate(movie_labels.tolist())}
+
+        """
+        Ratings are on the half star scale, so the arrays below store
+        them exactly as a number of half stars (2 * rating) in an int8.
+        """
+        if (np.any(values * 2 != np.round(values * 2)) or
+                np.any(values < 0) or np.any(values > 5)):
+            raise BadInputError("Ratings must be multiples of 0.5 from 0 to 5")
+        half_stars = (values * 2).astype(np.int8)
+
+        """
+        The raters of each movie in CSR form: the user rows (and their
+        half star ratings) for the movie in column col are
+        movie_users_flat[movie_users_indptr[col]:movie_users_indptr[col + 1]]
+        Within each movie the user rows are sorted, and each Movie
+        object is handed views of its slice.
+        """
+        num_movies = len(self.movie_index)
+        order = np.lexsort((rows, cols))
+        self.movie_users_indptr = np.zeros(num_movies + 1, dtype=np.int64)
+        np.cumsum(np.bincount(cols, minlength=num_movies),
+                  out=self.movie_users_indptr[1:])
+        self.movie_users_flat = rows[order]
+        self.movie_half_stars_flat = half_stars[order]
+
+        indptr = self.movie_users_indptr.tolist()
+        for mov_id, col in self.movie_index.items():
+            movie = movie_dict[mov_id]
+            movie.user_rows = self.movie_users_flat[indptr[col]:indptr[col + 1]]
+            movie.user_half_stars = self.movie_half_stars_flat[indptr[col]:indptr[col + 1]]
+
+        """
+        The ratings of each user in CSR form: the movie columns (and the
+        half star ratings given to them) for the user in row row are
+        user_movies_flat[user_movies_indptr[row]:user_movies_indptr[row + 1]]
+        with the movie columns sorted within each user.
+        """
+        num_users = len(self.user_index)
+        order = np.lexsort((cols, rows))
+        self.user_movies_indptr = np.zeros(num_users + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=num_users),
+                  out=self.user_movies_indptr[1:])
+        self.user_movies_flat = cols[order]
+        self.user_half_stars_flat = half_stars[order]
+
+        # sparse matrices for similarity_row, built on first use
+        self.count_lhs, self.count_rhs = None, None
+        self.diff_lhs, self.diff_rhs = None, None
+
+        # rows of the similarity matrix computed so far, keyed by movie column
+        self.sim_row_cache = dict()
 
     def predict_rating(self, user_id, movie_id):
         """
@@ -77,24 +156,120 @@ class Movie_Recommendations:
         If either user_id or movie_id is not in the database,
         then BadInputError is raised.
         """
-        if user_id not in self.user_dict or movie_id not in self.movie_dict:
-            raise BadInputError("User or movie id not in database")
-        ratings = self.user_dict[user_id]
+        return self.predict_ratings_for([(user_id, movie_id)])[0]
 
-        if movie_id in ratings:
-            return ratings[movie_id]
+    def predict_ratings_for(self, user_movie_ids):
+        """
+        Returns a list of the predicted ratings, one for each
+        (user id, movie id) pair in user_movie_ids, in the same order.
+        Predictions are made as described in predict_rating.
+        If any user id or movie id is not in the database,
+        then BadInputError is raised.
+        """
+
+        """
+        Gather the pairs by user, with each user's movies in CSR form
+        (a movie that appears more than once for the same user is only
+        predicted once).  Each target movie the user has not rated
+        needs its similarity row; rows_needed maps its column to the
+        row's position among the rows handed to predict_batch.
+        """
+        user_index, movie_index, user_dict = self.user_index, self.movie_index, self.user_dict
+        user_rows, target_cols, targets_indptr, targets = list(), list(), [0], list()
+        rows_needed = dict()
+        by_user = sorted(user_movie_ids, key=lambda user_movie_id: user_movie_id[0])
+        for user_id, group in groupby(by_user, key=lambda user_movie_id: user_movie_id[0]):
+            mov_ids = list(dict.fromkeys(mov_id for _, mov_id in group))
+            if user_id not in user_index or any(mov_id not in movie_index
+                                                for mov_id in mov_ids):
+                raise BadInputError("User or movie id not in database")
 
-        total, sum_of_similarities = 0, 0
-        for key in ratings:
-            similarity = self.movie_dict[key].get_similarity(movie_id, self.movie_dict, self.user_dict)
-            total += similarity * ratings[key]
-            sum_of_similarities += similarity
+            user_rows.append(user_index[user_id])
+            for mov_id in mov_ids:
+                col = movie_index[mov_id]
+                target_cols.append(col)
+                if mov_id not in user_dict[user_id]:
+                    rows_needed.setdefault(col, len(rows_needed))
+            targets_indptr.append(len(target_cols))
+            targets.extend((user_id, mov_id) for mov_id in mov_ids)
 
-        if sum_of_similarities != 0:    
-            return total / sum_of_similarities
+        # position of each target's similarity row, or -1 if it is already rated
+        target_sim_rows = np.array([rows_needed.get(col, -1) for col in target_cols],
+                                   dtype=np.int64)
+        if rows_needed:
+            similarity_rows = vstack([self.similarity_row(col) for col in rows_needed],
+                                     format='csr')
         else:
-            return 2.5    
-        
+            similarity_rows = csr_matrix((0, len(movie_index)))
+
+        predictions = predict_batch(np.array(user_rows, dtype=np.int64),
+                                    np.array(targets_indptr, dtype=np.int64),
+                                    np.array(target_cols, dtype=np.int32), target_sim_rows,
+                                    self.user_movies_indptr, self.user_movies_flat,
+                                    self.user_half_stars_flat, similarity_rows.indptr,
+                                    similarity_rows.indices, similarity_rows.data)
+        predictions = dict(zip(targets, predictions.tolist()))
+        return [predictions[user_movie_id] for user_movie_id in user_movie_ids]
+
+    def similarity_row(self, col):
+        """
+        Returns a 1 x (number of movies) csr_matrix of the similarities
+        between the movie in column col and every movie (indexed by
+        column).  Only movies with raters in common are stored.  The
+        row is computed on demand with sparse matrix products (the
+        matrices are built by build_similarity_matrices on the first
+        call), and stored in sim_row_cache so later predictions for
+        the same movie reuse it.  Once the cache holds
+        sim_row_cache_size rows, the oldest row is dropped to make room.
+        """
+        similarities = self.sim_row_cache.get(col)
+        if similarities is None:
+            if self.count_lhs is None:
+                self.build_similarity_matrices()
+            counts = (self.count_lhs[col] @ self.count_rhs).toarray().ravel()
+            diffs = (self.diff_lhs[col] @ self.diff_rhs).toarray().ravel()
+
+            co_rated = np.flatnonzero(counts)
+            values = 1 - (diffs[co_rated] / counts[co_rated]) / 4.5
+            similarities = csr_matrix((values, co_rated, [0, len(co_rated)]),
+                                      shape=(1, len(counts)))
+            if len(self.sim_row_cache) >= self.sim_row_cache_size:
+                del self.sim_row_cache[next(iter(self.sim_row_cache))]
+            self.sim_row_cache[col] = similarities
+        return similarities
+
+    def build_similarity_matrices(self):
+        """
+        Builds the sparse users x movies matrices similarity_row uses
+        to compute many similarities at once, from the per-user CSR
+        arrays.  For two ratings a and b, |a - b| = a + b - min(2a, 2b),
+        and with ratings on the half star scale min(2a, 2b) is the number
+        of levels k = 1..10 with 2a >= k and 2b >= k.  So with
+            rated - 1 where the user rated the movie
+            ratings - the rating
+            levels - one block of rows per level k, 1 where 2 * rating >= k
+        the sum of |a - b| over the users who rated both movies i and j is
+        (ratings.T @ rated + rated.T @ ratings - levels.T @ levels)[i, j]
+        and the number of such users is (rated.T @ rated)[i, j].
+        """
+        shape = (len(self.user_index), len(self.movie_index))
+        rows = np.repeat(np.arange(shape[0]), np.diff(self.user_movies_indptr))
+        cols = self.user_movies_flat
+        half_stars = self.user_half_stars_flat
+
+        rated = csr_matrix((np.ones(len(cols)), (rows, cols)), shape=shape)
+        ratings = csr_matrix((half_stars / 2, (rows, cols)), shape=shape)
+        levels = vstack([csr_matrix((np.ones(np.count_nonzero(half_stars >= k)),
+                                     (rows[half_stars >= k], cols[half_stars >= k])),
+                                    shape=shape)
+                         for k in range(1, 11)])
+
+        # movies x (stacked users) on the left, so that a single row of it
+        # times the right hand side gives one movie's sums against every movie
+        self.count_lhs = rated.T.tocsr()
+        self.count_rhs = rated.tocsr()
+        self.diff_lhs = vstack([rated, ratings, -levels]).T.tocsr()
+        self.diff_rhs = vstack([ratings, rated, levels]).tocsr()
 
     def predict_ratings(self, test_ratings_filename):
         """
@@ -105,22 +280,20 @@ class Movie_Recommendations:
         """
 
         try:
-            f = open(test_ratings_filename)
+            test = pd.read_csv(test_ratings_filename, usecols=[0, 1, 2],
+                               dtype={0: np.int64, 1: np.int64, 2: np.float64})
         except OSError:
             print("file not able to open")  
-     
-        csv_reader = csv.reader(f, delimiter=',')
-        f.readline()
 
-        movie_tuples_lst = list() 
+        test_ratings = list(zip(test.iloc[:, 0].tolist(), test.iloc[:, 1].tolist(),
+                                test.iloc[:, 2].tolist()))
 
-        for line in csv_reader:
-            user_id, mov_id, mov_rating = int(line[0]), int(line[1]), float(line[2])
-            movie_tuple = (user_id, str(self.movie_dict[mov_id]), 
-                           self.predict_rating(user_id, mov_id), mov_rating)
+        predictions = self.predict_ratings_for([(user_id, mov_id)
+                                                for user_id, mov_id, _ in test_ratings])
 
-            movie_tuples_lst.append(movie_tuple)
-        return movie_tuples_lst
+        movie_dict = self.movie_dict
+        return [(user_id, movie_dict[mov_id].title, prediction, mov_rating)
+                for (user_id, mov_id, mov_rating), prediction in zip(test_ratings, predictions)]
 
     def correlation(self, predicted_ratings, actual_ratings):
         """
@@ -128,12 +301,20 @@ class Movie_Recommendations:
         and the list actual_ratings.  The lengths of predicted_ratings and
         actual_ratings must be the same.
         """
-        return pearsonr(predicted_ratings, actual_ratings)[0]
+        predicted = np.asarray(predicted_ratings, dtype=np.float64)
+        actual = np.asarray(actual_ratings, dtype=np.float64)
+        predicted_centered = predicted - predicted.mean()
+        actual_centered = actual - actual.mean()
+        return float((predicted_centered @ actual_centered) /
+                     (predicted.std() * actual.std() * len(predicted)))
         
 class Movie: 
     """
     Represents a movie from the movie database.
     """
+    __slots__ = ('id', 'title', 'users', 'user_set', 'similarities',
+                 'user_rows', 'user_half_stars')
+
     def __init__(self, id, title):
         """ 
         Constructor.
@@ -145,18 +326,34 @@ class Movie:
         users: list of the id's of the users who have
             rated this movie.  Initially, this is
             an empty list, but will be filled in
-            as the training ratings file is read.
+            as the training ratings file is read.  A user who
+            rated the movie more than once is listed only once.
         similarities: a dictionary where the key is the
             id of another movie, and the value is the similarity
             between the "self" movie and the movie with that id.
             This dictionary is initially empty.  It is filled
-            in "on demand", as the file containing test ratings
-            is read, and ratings predictions are made.
+            in "on demand" by calls to get_similarity.  Rating
+            predictions don't use it; Movie_Recommendations keeps
+            its own cache of similarities (sim_row_cache).
+        user_set: frozenset of the id's of the users who have
+            rated this movie.  Mirrors users, and is built from it
+            once the training ratings file has been read.  Allows
+            movies with no users in common to be found by a set
+            test.
+        user_rows: sorted array of the row indices of the users
+            who have rated this movie, set once the training
+            ratings file has been read.
+        user_half_stars: int8 array of the ratings those users
+            gave, as a number of half stars (2 * rating), in the
+            same order as user_rows.
         """
         self.id = id
         self.title = title
         self.users = list()
+        self.user_set = frozenset()
         self.similarities = dict()
+        self.user_rows = None
+        self.user_half_stars = None
 
 
     def __str__(self):
@@ -204,21 +401,96 @@ class Movie:
         id is other_movie_id.  (Uses movie_dict and user_dict)
         """
 
-        num_of_ratings, abs_diff_of_ratings = 0, 0
+        other_movie = movie_dict[other_movie_id]
+        if self.user_set.isdisjoint(other_movie.user_set):
+            return 0
+
+        return co_rated_similarity(self.user_rows, self.user_half_stars,
+                                   other_movie.user_rows, other_movie.user_half_stars)
 
-        for key in user_dict:
-            if self.id in user_dict[key] and other_movie_id in user_dict[key]:
-                rtg_1 = user_dict[key][self.id]
-                rtg_2 = user_dict[key][other_movie_id]
-                abs_diff_of_ratings += abs(rtg_1 - rtg_2)
-                num_of_ratings += 1
 
-        if num_of_ratings != 0:
-            avg_difference = (abs_diff_of_ratings / num_of_ratings)
-            return (1 - avg_difference/4.5) 
+@njit(cache=True)
+def co_rated_similarity(users_1, half_stars_1, users_2, half_stars_2):
+    """
+    Returns the similarity of two movies, given the sorted rows of
+    the users who rated each one and the ratings they gave (in half
+    stars).  The users who rated both movies are found by merging the
+    two sorted arrays.  The similarity is 1 - (average absolute
+    difference of their ratings) / 4.5, or 0 if no user rated both movies.
+    """
+    i, j = 0, 0
+    num_of_ratings, abs_diff_of_half_stars = 0, 0
+    while i < len(users_1) and j < len(users_2):
+        if users_1[i] < users_2[j]:
+            i += 1
+        elif users_1[i] > users_2[j]:
+            j += 1
         else:
-            return 0   
-        
+            abs_diff_of_half_stars += abs(int(half_stars_1[i]) - int(half_stars_2[j]))
+            num_of_ratings += 1
+            i += 1
+            j += 1
+
+    if num_of_ratings != 0:
+        avg_difference = abs_diff_of_half_stars / (2 * num_of_ratings)
+        return 1 - avg_difference/4.5
+    else:
+        return 0.0
+
+
+@njit(parallel=True, cache=True)
+def predict_batch(user_rows, targets_indptr, target_cols, target_sim_rows,
+                  user_movies_indptr, user_movies_flat, user_half_stars_flat,
+                  sim_indptr, sim_indices, sim_data):
+    """
+    Returns an array of predicted ratings, one for each target movie.
+    The target movie columns for the user in row user_rows[k] are
+    target_cols[targets_indptr[k]:targets_indptr[k + 1]], and the
+    predictions are returned in the same order as target_cols.
+    user_movies_indptr, user_movies_flat and user_half_stars_flat are
+    the per-user CSR arrays of Movie_Recommendations.  The similarity
+    rows are given as the CSR arrays sim_indptr, sim_indices (sorted
+    movie columns) and sim_data; target t uses row target_sim_rows[t],
+    which is only read when the user has not rated the target.
+    If the user has rated the target, the prediction is that rating.
+    Otherwise it is the average of the user's ratings weighted by
+    their movies' similarities to the target, or 2.5 if those
+    similarities sum to 0.  The users are handled in parallel.
+    """
+    predictions = np.empty(len(target_cols))
+    for k in prange(len(user_rows)):
+        row = user_rows[k]
+        rated_cols = user_movies_flat[user_movies_indptr[row]:user_movies_indptr[row + 1]]
+        half_stars = user_half_stars_flat[user_movies_indptr[row]:user_movies_indptr[row + 1]]
+
+        for t in range(targets_indptr[k], targets_indptr[k + 1]):
+            col = target_cols[t]
+            position = np.searchsorted(rated_cols, col)
+            if position < len(rated_cols) and rated_cols[position] == col:
+                predictions[t] = half_stars[position] / 2
+                continue
+
+            # merge the user's sorted rated columns with the row's sorted columns
+            i, j = 0, sim_indptr[target_sim_rows[t]]
+            end = sim_indptr[target_sim_rows[t] + 1]
+            total, sum_of_similarities = 0.0, 0.0
+            while i < len(rated_cols) and j < end:
+                if rated_cols[i] < sim_indices[j]:
+                    i += 1
+                elif rated_cols[i] > sim_indices[j]:
+                    j += 1
+                else:
+                    total += sim_data[j] * (half_stars[i] / 2)
+                    sum_of_similarities += sim_data[j]
+                    i += 1
+                    j += 1
+
+            if sum_of_similarities != 0:
+                predictions[t] = total / sum_of_similarities
+            else:
+                predictions[t] = 2.5
+    return predictions
+
 
 if __name__ == "__main__":
     #Create_movie_recommendations object.
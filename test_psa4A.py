@@ -6,6 +6,7 @@
 #              on a small dummy set of ratings.
 
 import sys
+import csv
 
 # import the module containing psa4 solution
 import movie_recommendations
@@ -192,6 +193,47 @@ def test_psa4():
     else:
         print("  failed.  Should have raised BadInputError.")
 
+    # Test Movie_Recommendations constructor with a training
+    # rating that is not on the half star scale.
+    num_tested += 1
+    print("Testing Movie_Recommendation constructor with a rating")
+    print("  that is not a multiple of 0.5")
+    try:
+        mr = movie_recommendations.Movie_Recommendations(
+            "dummy_movies.csv", "dummy_off_scale_training_ratings.csv")
+    except movie_recommendations.BadInputError:
+        print("  passed")
+        num_correct += 1
+    except Exception as e:
+        print(f"  failed.  Your code raised the exception {e}")
+        print("  Should have raised BadInputError.")
+    else:
+        print("  failed.  Should have raised BadInputError.")
+
+    # Test Movie_Recommendations constructor with a training
+    # file that rates the same movie twice for one user.
+    num_tested += 1
+    print("Testing Movie_Recommendation constructor with a user who")
+    print("  rated the same movie twice (the last rating should count)")
+    try:
+        mr = movie_recommendations.Movie_Recommendations(
+            "dummy_movies.csv", "dummy_duplicate_training_ratings.csv")
+        ud = mr.user_dict
+        md = mr.movie_dict
+        if ud[1][1] != 5:
+            raise IncorrectCode(f"rating of movie 1 by user 1 is {ud[1][1]}.  Should be 5")
+        if md[1].users.count(1) != 1:
+            raise IncorrectCode(f"movie id 1 should list user 1 once.  Its users are {md[1].users}")
+        predicted_rating = mr.predict_rating(1, 1)
+        if predicted_rating != 5:
+            raise IncorrectCode(f"predict_rating(1, 1) returned {predicted_rating}.  Should be 5")
+        print("  passed")
+        num_correct += 1
+    except IncorrectCode as e:
+        print(f"  failed. {e}")
+    except Exception as e:
+        print(f"  failed.  Your code raised the exception {e}")
+
     # Test predict_ratings.
     num_tested += 1
     print("Testing predict_ratings")
@@ -215,6 +257,77 @@ def test_psa4():
         print("Should be ")
         print("[(2, 'M1', 4.11, 5.0), (2, 'M5', 3.82, 5.0), (3, 'M1', 1.5, 0.0), (3, 'M3', 3.0, 3.0), (3, 'M5', 1.43, 5.0), (4, 'M2', 1.1, 4.0), (5, 'M1', 5.0, 2.0), (5, 'M2', 5.0, 2.0), (5, 'M5', 5.0, 2.0)]")
     
+    # Test that predict_ratings, predict_rating and
+    # compute_similarity agree with each other.
+    num_tested += 1
+    print("Testing predict_ratings agrees with predict_rating, and")
+    print("  similarity_row agrees with compute_similarity")
+    try:
+        mr = movie_recommendations.Movie_Recommendations(
+            "dummy_movies.csv", "dummy_training_ratings.csv")
+        ud = mr.user_dict
+        md = mr.movie_dict
+        predicted_ratings = mr.predict_ratings("dummy_test_ratings.csv")
+        with open("dummy_test_ratings.csv", newline='') as f:
+            test_ratings = list(csv.reader(f))[1:]
+        for entry, line in zip(predicted_ratings, test_ratings):
+            user_id, movie_id = int(line[0]), int(line[1])
+            predicted_rating = mr.predict_rating(user_id, movie_id)
+            if round(entry[2], 9) != round(predicted_rating, 9):
+                raise IncorrectCode(f"predict_ratings gave {entry[2]} for user {user_id} and movie {movie_id}, but predict_rating gave {predicted_rating}")
+        for movie_id in md:
+            row = mr.similarity_row(mr.movie_index[movie_id]).toarray().ravel()
+            for other_movie_id in md:
+                if movie_id != other_movie_id:
+                    similarity = md[movie_id].compute_similarity(other_movie_id, md, ud)
+                    if round(row[mr.movie_index[other_movie_id]], 9) != round(similarity, 9):
+                        raise IncorrectCode(f"similarity_row and compute_similarity disagree for movies {movie_id} and {other_movie_id}")
+        print("  passed")
+        num_correct += 1
+    except IncorrectCode as e:
+        print(f"  failed. {e}")
+    except Exception as e:
+        print(f"  failed.  Your code raised the exception {e}")
+
+    # Test that sim_row_cache stays within sim_row_cache_size,
+    # dropping the oldest row first, without changing predictions.
+    num_tested += 1
+    print("Testing sim_row_cache is limited to sim_row_cache_size rows")
+    try:
+        mr = movie_recommendations.Movie_Recommendations(
+            "dummy_movies.csv", "dummy_training_ratings.csv")
+        unlimited_mr = movie_recommendations.Movie_Recommendations(
+            "dummy_movies.csv", "dummy_training_ratings.csv")
+        ud = mr.user_dict
+        mr.sim_row_cache_size = 2
+        with open("dummy_test_ratings.csv", newline='') as f:
+            test_ratings = list(csv.reader(f))[1:]
+        # the rows the cache should hold, oldest first, and how many were computed
+        expected_cache, num_rows_computed = list(), 0
+        for line in test_ratings:
+            user_id, movie_id = int(line[0]), int(line[1])
+            predicted_rating = mr.predict_rating(user_id, movie_id)
+            if predicted_rating != unlimited_mr.predict_rating(user_id, movie_id):
+                raise IncorrectCode(f"predict_rating({user_id}, {movie_id}) changed when the cache is limited")
+            if len(mr.sim_row_cache) > 2:
+                raise IncorrectCode(f"sim_row_cache holds {len(mr.sim_row_cache)} rows.  Should hold at most 2")
+            col = mr.movie_index[movie_id]
+            if movie_id not in ud[user_id] and col not in expected_cache:
+                if len(expected_cache) == 2:
+                    expected_cache.pop(0)
+                expected_cache.append(col)
+                num_rows_computed += 1
+            if list(mr.sim_row_cache) != expected_cache:
+                raise IncorrectCode(f"sim_row_cache holds rows {list(mr.sim_row_cache)}.  Should hold {expected_cache}, oldest first")
+        if num_rows_computed <= 2:
+            raise IncorrectCode("test ratings should need more than 2 similarity rows")
+        print("  passed")
+        num_correct += 1
+    except IncorrectCode as e:
+        print(f"  failed. {e}")
+    except Exception as e:
+        print(f"  failed.  Your code raised the exception {e}")
+
     # test correlation on dummy test ratings
     num_tested += 1
     print("Testing overall correctness by computing correlation for predictions of test ratings")